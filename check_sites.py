@@ -1,42 +1,77 @@
 import os
-import difflib
 import asyncio
 import re
-import tempfile
+import hashlib
+import functools
+import json
+import textwrap
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
 from urllib.parse import urlparse
 #> 网络请求和浏览器自动化
-import requests
-from playwright.async_api import async_playwright
-#> 图片处理和生成
-from PIL import Image, ImageDraw, ImageFont, ImageColor
-#> HTML/XML 解析和处理
-from bs4 import BeautifulSoup
+import httpx
+#> HTML/CSS 处理
 import html
 import cssbeautifier
 #> Telegram 机器人功能
 from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.request import HTTPXRequest
-#> 代码语法高亮
-from pygments import highlight
-from pygments.lexers import get_lexer_for_filename, guess_lexer, TextLexer
-from pygments.formatters import ImageFormatter
-from pygments.style import Style
-from pygments.token import Token
+#> 文本差异比较
+from diff_match_patch import diff_match_patch
 
 # === 配置 ===
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID")
 ADMIN_USER_ID = int(os.getenv("TELEGRAM_ADMIN_ID"))  # Telegram 用户 ID
 DATA_DIR = Path("data")
+INDEX_FILE = DATA_DIR / "index.json"  # 各站点的内容哈希和ETag/Last-Modified
 LOG_FILE = Path("changes.log")
 FONT_FILE = "aliph.ttf"  # 直接使用当前目录下的字体文件
+SNAPSHOT_VERSION = "# fmt:v2"  # 快照格式版本，修改格式化规则时递增
+# 设为 zstd 时快照以zstd压缩保存（需要安装 zstandard）；
+# GitHub Actions 会把 data/ 提交回仓库，默认保存纯文本，便于git增量存储和查看历史
+SNAPSHOT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "").lower()
+# 同时处理的站点数（至少为1，避免信号量为0时所有任务永久等待；无效值时使用默认值8）
+try:
+    MAX_CONCURRENT_SITES = max(1, int(os.getenv("MAX_CONCURRENT_SITES", "8")))
+except ValueError:
+    MAX_CONCURRENT_SITES = 8
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}  # 动态页面中不加载的资源类型
+TEXT_DIFF_MAX_LINES = 40  # 不超过该行数的diff直接以文本消息发送，不生成图片
+TELEGRAM_MESSAGE_LIMIT = 4096  # Telegram单条消息的最大长度
+
+# 请求页面时使用的User-Agent
+MOBILE_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1"
+DESKTOP_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+
+WHITESPACE_RE = re.compile(r"\s+")
+NEWLINE_RE = re.compile(r"\r\n?")
+HTML_TAG_RE = re.compile(r"<[a-zA-Z]")  # 判断内容中是否含有HTML标签
+TAG_START_RE = re.compile(r"\s*(<[a-zA-Z/!])")  # 标签开头（含前面的空白）
+TAG_END_SPACE_RE = re.compile(r">\s+")  # 标签结尾后的空白
+STYLE_BLOCK_RE = re.compile(r"(<style\b[^>]*>)(.*?)(\n</style>)", re.I | re.S)
+
+# CSS格式化选项（只创建一次，所有style块共用）
+CSS_OPTIONS = cssbeautifier.default_options()
+CSS_OPTIONS.indent = "  "  # 使用两个空格缩进
+CSS_OPTIONS.openbrace = "separate-line"  # 大括号单独一行
+
+# 共享的diff引擎（不保存比较状态，可在线程间复用）
+DIFF_ENGINE = diff_match_patch()
+DIFF_ENGINE.Diff_Timeout = 1.0  # 超时后返回可用但不一定最小的diff
 
 DATA_DIR.mkdir(exist_ok=True)
 LOG_FILE.touch(exist_ok=True)
 
+# 本轮运行的变更日志，结束时一次性追加到 changes.log
+CHANGE_LOG_LINES = []
+
 # 创建自定义请求对象，增加连接池大小和超时时间
 request = HTTPXRequest(
     connection_pool_size=20,  # 增加连接池大小
@@ -48,182 +83,368 @@ request = HTTPXRequest(
 bot = Bot(token=BOT_TOKEN, request=request)
 
 
-# === 自定义VSCode风格 ===
-class VSCodeStyle(Style):
-    """
-    仿VSCode风格的语法高亮样式
-    """
-
-    styles = {
-        Token: "#D4D4D4",  # 默认文本颜色
-        Token.Comment: "#6A9955",  # 注释 - 绿色
-        Token.Keyword: "#C586C0",  # 关键字 - 紫色
-        Token.String: "#CE9178",  # 字符串 - 棕色
-        Token.Name: "#D4D4D4",  # 变量名 - 白色
-        Token.Name.Function: "#DCDCAA",  # 函数名 - 米黄色
-        Token.Name.Class: "#4EC9B0",  # 类名 - 青蓝色
-        Token.Number: "#B5CEA8",  # 数字 - 浅绿色
-        Token.Operator: "#D4D4D4",  # 操作符 - 白色
-        Token.Punctuation: "#D4D4D4",  # 标点 - 白色
-    }
-
-
 # === 工具函数 ===
 def get_cst_time():
     return (datetime.utcnow() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S CST")
 
 
+def log_change(timestamp, url, text):
+    CHANGE_LOG_LINES.append(f"[{timestamp}] {url} {text}\n")
+
+
+def flush_change_log():
+    """把本轮累积的变更日志一次性写入文件"""
+    if CHANGE_LOG_LINES:
+        with LOG_FILE.open("a", encoding="utf-8") as log:
+            log.writelines(CHANGE_LOG_LINES)
+        CHANGE_LOG_LINES.clear()
+
+
 def normalize_text(text):
-    return text.replace("\r\n", "\n").strip()
+    # 统一换行符（\r\n 和单独的 \r 都转为 \n），不含\r时无需正则替换
+    if "\r" in text:
+        text = NEWLINE_RE.sub("\n", text)
+    return text.strip()
 
 
-async def get_page_content(url, dynamic=False):
-    try:
-        # 解析URL获取域名
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc
+@functools.lru_cache(maxsize=256)
+def ua_for(domain):
+    """移动版域名（m. 或 mobile. 开头）使用移动版User-Agent"""
+    if domain.startswith(("m.", "mobile.")):
+        return MOBILE_UA
+    return DESKTOP_UA
+
+
+async def block_heavy_resources(route):
+    """拦截图片、字体和媒体请求，它们不影响页面HTML"""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
 
-        # 检查域名是否包含"m."，如果是则使用移动版User-Agent
-        is_mobile_domain = "m." in domain
+
+async def get_page_content(
+    url, dynamic=False, client=None, browser=None, validators=None
+):
+    """抓取页面内容，返回 (内容, 缓存校验信息)
+
+    静态页面会带上上次的ETag/Last-Modified发起条件请求，
+    服务器返回304时内容为None，表示页面未变化
+    """
+    try:
+        # 根据域名选择User-Agent
+        user_agent = ua_for(urlparse(url).hostname or "")
 
         if dynamic:
-            # 使用异步Playwright API
-            async with async_playwright() as p:
-                browser = await p.chromium.launch(headless=True)
-                context = await browser.new_context(
-                    user_agent=(
-                        "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1"
-                        if is_mobile_domain
-                        else "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
-                    )
-                )
+            # 浏览器启动失败时，动态页面按访问失败处理，不影响其他站点
+            if browser is None:
+                return "ERROR: 浏览器未启动", {}
+            # 复用共享的浏览器实例，每个页面使用独立的上下文
+            context = await browser.new_context(user_agent=user_agent)
+            try:
+                await context.route("**/*", block_heavy_resources)
                 page = await context.new_page()
                 await page.goto(url, timeout=30000, wait_until="networkidle")
                 content = await page.content()
-                await browser.close()
-                return normalize_text(content)
+            finally:
+                await context.close()
+            # 动态页面由浏览器渲染，不使用条件请求
+            return normalize_text(content), {}
         else:
-            # 对于非动态内容，仍然使用requests（同步）
-            headers = {
-                "User-Agent": (
-                    "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1"
-                    if is_mobile_domain
-                    else "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
-                )
-            }
-            # 在异步函数中运行同步代码
-            loop = asyncio.get_event_loop()
-            resp = await loop.run_in_executor(
-                None, lambda: requests.get(url, headers=headers, timeout=15)
-            )
-            resp.encoding = "utf-8"
-            return normalize_text(resp.text)
+            # 对于非动态内容，使用共享的HTTP/2客户端（复用连接，同域名多路复用）
+            headers = {"User-Agent": user_agent}
+            if validators:
+                if validators.get("etag"):
+                    headers["If-None-Match"] = validators["etag"]
+                if validators.get("last_modified"):
+                    headers["If-Modified-Since"] = validators["last_modified"]
+            resp = await client.get(url, headers=headers)
+            if resp.status_code == 304:
+                # 未修改，没有正文
+                return None, validators
+            text = resp.content.decode("utf-8", errors="replace")
+            new_validators = {}
+            if resp.status_code == 200:
+                new_validators = {
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                }
+            return normalize_text(text), new_validators
     except Exception as e:
-        return f"ERROR: {e}"
+        return f"ERROR: {e}", {}
 
 
 def safe_filename(url):
     return url.replace("://", "_").replace("/", "_").replace("?", "_").replace("&", "_")
 
 
+def split_lines(content):
+    """按换行符拆分内容，空内容对应空列表"""
+    return content.split("\n") if content else []
+
+
+def open_snapshot(snapshot_file, mode="r"):
+    """以文本方式打开快照，.zst 快照在读写时透明地解压/压缩"""
+    if snapshot_file.suffix == ".zst":
+        import zstandard
+
+        return zstandard.open(
+            snapshot_file, mode + "t", encoding="utf-8", errors="ignore"
+        )
+    return snapshot_file.open(mode, encoding="utf-8", errors="ignore")
+
+
+def read_snapshot(snapshot_file, is_text=False):
+    """
+    逐行读取已格式化的快照，返回行列表；
+    HTML快照的格式版本不符时返回None（旧格式无法与新格式比较，需要重建）
+    """
+    with open_snapshot(snapshot_file) as f:
+        first_line = f.readline()
+        if first_line.rstrip("\n") == SNAPSHOT_VERSION:
+            return [line.rstrip("\n") for line in f]
+        if not is_text:
+            return None
+        text = f.read()
+    # 纯文本快照不经过HTML格式化，旧版本的内容仍可直接比较
+    if not first_line.startswith("# fmt:"):
+        text = first_line + text
+    return split_lines(normalize_text(text))
+
+
+def atomic_write(path, data):
+    """先写临时文件再替换，写入中断时不会留下残缺的文件"""
+    tmp_file = path.with_name(path.name + ".tmp")
+    tmp_file.write_text(data, encoding="utf-8")
+    os.replace(tmp_file, path)
+
+
+def load_index():
+    """读取站点索引：URL → {快照格式、内容哈希、ETag/Last-Modified}"""
+    try:
+        index = json.loads(INDEX_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def save_index(index):
+    """写回站点索引"""
+    atomic_write(
+        INDEX_FILE,
+        json.dumps(index, ensure_ascii=False, indent=1, sort_keys=True) + "\n",
+    )
+
+
+def write_snapshot(snapshot_file, content):
+    """写入快照，首行为格式版本标记"""
+    # 同样先写临时文件再替换；临时文件保留原后缀，.zst 快照照常压缩
+    tmp_file = snapshot_file.with_stem(snapshot_file.stem + ".tmp")
+    with open_snapshot(tmp_file, "w") as f:
+        f.write(f"{SNAPSHOT_VERSION}\n")
+        f.write(content)
+    os.replace(tmp_file, snapshot_file)
+
+
 def format_css_content(css_content):
     """格式化CSS内容"""
     try:
         # 使用cssbeautifier格式化CSS
-        options = cssbeautifier.default_options()
-        options.indent = "  "  # 使用两个空格缩进
-        options.openbrace = "separate-line"  # 大括号单独一行
-        return cssbeautifier.beautify(css_content, options)
+        return cssbeautifier.beautify(css_content, CSS_OPTIONS)
     except Exception as e:
         logging.error(f"CSS格式化失败: {e}")
         return css_content  # 失败时返回原始内容
 
 
 def format_html_content(html_content):
-    """格式化HTML内容，提高diff可读性"""
+    """
+    格式化HTML内容，提高diff可读性：每个标签单独一行，style中的CSS展开排版
+    """
+    # 很短或不含标签的内容（如JSON、纯文本接口）无需格式化
+    if len(html_content) < 512 or not HTML_TAG_RE.search(html_content):
+        return normalize_text(html_content)
+
     try:
-        # 使用BeautifulSoup解析并格式化HTML
-        soup = BeautifulSoup(html_content, "html.parser")
+        # 压缩连续的空白字符
+        formatted_html = WHITESPACE_RE.sub(" ", html_content)
+
+        # 去掉标签后的空白，并在每个标签前换行
+        formatted_html = TAG_END_SPACE_RE.sub(">", formatted_html)
+        formatted_html = TAG_START_RE.sub(r"\n\1", formatted_html)
 
         # 处理style标签中的CSS内容
-        for style_tag in soup.find_all("style"):
-            if style_tag.string:
-                try:
-                    # 格式化CSS内容
-                    formatted_css = format_css_content(style_tag.string)
-                    style_tag.string = formatted_css
-                except Exception as e:
-                    logging.warning(f"格式化CSS内容失败: {e}")
-                    # 如果格式化失败，保持原样
-
-        # 压缩和美化HTML
-        for element in soup.find_all(True):
-            # 压缩连续的空白字符
-            if element.string:
-                element.string = " ".join(element.string.split())
-
-        # 格式化HTML（设置缩进）
-        formatted_html = soup.prettify(formatter="html")
+        formatted_html = STYLE_BLOCK_RE.sub(
+            lambda m: f"{m[1]}\n{format_css_content(m[2])}{m[3]}", formatted_html
+        )
 
         # 处理特殊字符
         formatted_html = html.unescape(formatted_html)
 
-        # 移除多余空行（保留最多连续2个空行）
-        lines = []
-        empty_count = 0
-        for line in formatted_html.splitlines():
-            if line.strip() == "":
-                empty_count += 1
-                if empty_count <= 2:
-                    lines.append(line)
-            else:
-                empty_count = 0
-                lines.append(line)
-
-        return normalize_text("\n".join(lines))
+        return normalize_text(formatted_html)
     except Exception as e:
         logging.error(f"HTML格式化失败: {e}")
         return html_content  # 失败时返回原始内容
 
 
-def highlight_code(code, filename="file.py"):
+def format_hunk_range(start, stop):
+    """按统一diff格式输出hunk的行范围（与difflib保持一致）"""
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def build_diff(old_lines, new_lines, context=3):
     """
-    使用Pygments对代码进行语法高亮
+    使用diff-match-patch按行比较新旧内容（行列表），返回统一diff格式的行列表
     """
-    try:
-        # 尝试根据文件名猜测语言
-        try:
-            lexer = get_lexer_for_filename(filename)
-        except:
-            # 如果失败，尝试根据内容猜测语言
-            try:
-                lexer = guess_lexer(code)
-            except:
-                # 如果还是失败，使用纯文本lexer
-                lexer = TextLexer()
-
-        # 创建临时文件来保存高亮后的图像
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-            # 使用自定义的VSCode样式
-            formatter = ImageFormatter(
-                style=VSCodeStyle,
-                line_numbers=True,  # 显示行号
-                font_name="DejaVu Sans Mono",  # 使用等宽字体
-                font_size=14,
-                line_number_bg="#2B2B2B",  # 行号背景色
-                line_number_fg="#6E7681",  # 行号前景色
-                image_format="png",
-            )
-
-            highlight(code, lexer, formatter, temp_file.name)
-            return temp_file.name
-    except Exception as e:
-        logging.error(f"代码高亮失败: {e}")
+    dmp = DIFF_ENGINE
+
+    # 去掉首尾相同的行，只比较中间变化的部分（保留context行用作hunk上下文），
+    # 大页面的局部改动无需再对整页做行编码和逐行展开
+    n = min(len(old_lines), len(new_lines))
+    prefix = 0
+    while prefix < n and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+    if prefix == len(old_lines) == len(new_lines):
+        return []
+    start = max(prefix - context, 0)
+    trim = max(suffix - context, 0)
+    old_lines = old_lines[start : len(old_lines) - trim]
+    new_lines = new_lines[start : len(new_lines) - trim]
+
+    # 与diff_linesToChars相同的思路：把每一行编码成一个字符，
+    # 让比较以整行为单位进行，直接处理行列表，无需先拼接成大字符串
+    line_ids = {}
+    chars_old = "".join(chr(line_ids.setdefault(l, len(line_ids))) for l in old_lines)
+    chars_new = "".join(chr(line_ids.setdefault(l, len(line_ids))) for l in new_lines)
+    line_array = list(line_ids)
+
+    diffs = dmp.diff_main(chars_old, chars_new, False)
+    # 在行编码上做语义清理，结果仍然按整行对齐
+    dmp.diff_cleanupSemantic(diffs)
+
+    # 展开为逐行的 (标记, 内容) 列表
+    tags = {dmp.DIFF_DELETE: "-", dmp.DIFF_EQUAL: " ", dmp.DIFF_INSERT: "+"}
+    ops = []
+    for op, chars in diffs:
+        ops.extend((tags[op], line_array[ord(c)]) for c in chars)
+
+    changed = [i for i, (tag, _) in enumerate(ops) if tag != " "]
+    if not changed:
+        return []
+
+    # 相邻变更之间的相同行不超过 2*context 时合并为同一个hunk
+    groups = []
+    first = last = changed[0]
+    for i in changed[1:]:
+        if i - last - 1 > 2 * context:
+            groups.append((first, last))
+            first = i
+        last = i
+    groups.append((first, last))
+
+    # 每个位置之前的旧/新行数，用于计算hunk行号（加上裁掉的相同前缀）
+    old_pos = [start]
+    new_pos = [start]
+    for tag, _ in ops:
+        old_pos.append(old_pos[-1] + (tag != "+"))
+        new_pos.append(new_pos[-1] + (tag != "-"))
+
+    diff_lines = []
+    for first, last in groups:
+        lo = max(first - context, 0)
+        hi = min(last + context + 1, len(ops))
+        old_range = format_hunk_range(old_pos[lo], old_pos[hi])
+        new_range = format_hunk_range(new_pos[lo], new_pos[hi])
+        diff_lines.append(f"@@ -{old_range} +{new_range} @@")
+        diff_lines.extend(tag + line for tag, line in ops[lo:hi])
+    return diff_lines
+
+
+def build_text_diff_message(caption, diff_lines):
+    """
+    把较小的diff排版为MarkdownV2代码块消息；diff过大时返回None（改用图片发送）
+    """
+    if len(diff_lines) > TEXT_DIFF_MAX_LINES:
+        return None
+    message = (
+        escape_markdown(caption, version=2)
+        + "\n```diff\n"
+        + escape_markdown("\n".join(diff_lines), version=2, entity_type="pre")
+        + "\n```"
+    )
+    if len(message) > TELEGRAM_MESSAGE_LIMIT:
         return None
+    return message
+
+
+def make_text_measurer(font):
+    """
+    返回测量文本宽度的函数，按字符缓存字宽，避免对整行反复调用getbbox
+    """
+    advances = {}
+
+    def char_width(ch):
+        if hasattr(font, "getlength"):
+            return font.getlength(ch)
+        bbox = font.getbbox(ch) if hasattr(font, "getbbox") else font.getsize(ch)
+        return bbox[2] - bbox[0] if hasattr(font, "getbbox") else bbox[0]
+
+    def text_width(text):
+        width = 0
+        for ch in text:
+            advance = advances.get(ch)
+            if advance is None:
+                advance = advances[ch] = char_width(ch)
+            width += advance
+        return width
+
+    return text_width
+
+
+def make_glyph_atlas(font):
+    """
+    返回按字符缓存字形蒙版的获取函数，每个字符只经过一次FreeType渲染
+    """
+    from PIL import Image, ImageDraw
+
+    glyphs = {}
+
+    def get_glyph(ch):
+        glyph = glyphs.get(ch)
+        if glyph is None:
+            left, top, right, bottom = font.getbbox(ch)
+            mask = None
+            if right > left and bottom > top:
+                mask = Image.new("L", (right - left, bottom - top), 0)
+                ImageDraw.Draw(mask).text((-left, -top), ch, font=font, fill=255)
+            glyph = glyphs[ch] = (mask, left, top)
+        return glyph
 
+    return get_glyph
 
-def wrap_line(line, font, max_width):
+
+def wrap_line(line, text_width, max_width, mono_width=None):
     """将长行拆分为多行以适应最大宽度"""
+    # 等宽字体下的ASCII行：宽度只取决于字符数，直接按列数换行
+    if mono_width and line.isascii():
+        columns = max(int(max_width // mono_width), 1)
+        wrapped_lines = textwrap.wrap(
+            line,
+            width=columns,
+            break_long_words=True,
+            drop_whitespace=False,
+            replace_whitespace=False,
+            expand_tabs=False,
+        )
+        return [wrapped.rstrip() for wrapped in wrapped_lines] or [""]
+
     words = []
     current_word = ""
 
@@ -240,26 +461,22 @@ def wrap_line(line, font, max_width):
     if current_word:
         words.append(current_word)
 
-    # 构建行列表
+    # 构建行列表（累加单词宽度，无需重新测量整行）
     wrapped_lines = []
     current_line = ""
+    current_width = 0
 
     for word in words:
-        # 测量添加单词后的宽度
-        test_line = current_line + word
-        bbox = (
-            font.getbbox(test_line)
-            if hasattr(font, "getbbox")
-            else font.getsize(test_line)
-        )
-        test_width = bbox[2] - bbox[0] if hasattr(font, "getbbox") else bbox[0]
+        word_width = text_width(word)
 
         # 如果当前行不为空且添加单词后超宽，则换行
-        if current_line and test_width > max_width:
+        if current_line and current_width + word_width > max_width:
             wrapped_lines.append(current_line.rstrip())
             current_line = word
+            current_width = word_width
         else:
-            current_line = test_line
+            current_line += word
+            current_width += word_width
 
     if current_line:
         wrapped_lines.append(current_line.rstrip())
@@ -267,9 +484,22 @@ def wrap_line(line, font, max_width):
     return wrapped_lines
 
 
+# diff行首字符对应的颜色
+DIFF_LINE_COLORS = {
+    "+": (155, 185, 85),  # 柔和的绿色
+    "-": (224, 108, 117),  # 柔和的红色
+    "@": (86, 156, 214),  # 蓝色
+}
+DIFF_DEFAULT_COLOR = (212, 212, 212)  # 浅灰色
+DIFF_MARKERS = {"+", "-", "@", " "}
+
+
 def diff_to_image(
     diff_text, output_file, min_width=400, max_width=1200, line_height_pad=8
 ):
+    # Pillow只在需要生成图片时才导入（在进程池中执行）
+    from PIL import Image, ImageDraw, ImageFont
+
     # 创建新的行列表，用于处理换行
     processed_lines = []
 
@@ -318,6 +548,11 @@ def diff_to_image(
         bbox[3] - bbox[1] if hasattr(font, "getbbox") else bbox[1]
     ) + line_height_pad
 
+    # 按字符缓存字宽的测量函数
+    text_width = make_text_measurer(font)
+    # 等宽字体只需记录一个字符宽度
+    mono_width = text_width("M") if text_width("i") == text_width("M") else None
+
     # 处理每一行，进行换行
     line_numbers = []
     line_number_width = 0
@@ -325,13 +560,9 @@ def diff_to_image(
 
     for line in diff_text.splitlines():
         line_count += 1
-        # 测量行宽度
-        bbox = font.getbbox(line) if hasattr(font, "getbbox") else font.getsize(line)
-        line_width = bbox[2] - bbox[0] if hasattr(font, "getbbox") else bbox[0]
-
         # 如果行太长，则换行处理
-        if line_width > max_content_width:
-            wrapped_lines = wrap_line(line, font, max_content_width)
+        if text_width(line) > max_content_width:
+            wrapped_lines = wrap_line(line, text_width, max_content_width, mono_width)
             processed_lines.extend(wrapped_lines)
             line_numbers.extend([line_count] + [""] * (len(wrapped_lines) - 1))
         else:
@@ -341,11 +572,7 @@ def diff_to_image(
     # 计算行号区域的宽度
     if line_numbers:
         max_line_num = max([num for num in line_numbers if num != ""])
-        line_number_width = (
-            font.getbbox(str(max_line_num))[2] - font.getbbox(str(max_line_num))[0]
-            if hasattr(font, "getbbox")
-            else font.getsize(str(max_line_num))[0]
-        )
+        line_number_width = text_width(str(max_line_num))
         line_number_width += 20  # 增加一些边距
 
     # 计算图片高度和宽度
@@ -354,197 +581,321 @@ def diff_to_image(
     # 重新计算最大行宽度（考虑换行后）
     max_line_width = 0
     for line in processed_lines:
-        bbox = font.getbbox(line) if hasattr(font, "getbbox") else font.getsize(line)
-        width = bbox[2] - bbox[0] if hasattr(font, "getbbox") else bbox[0]
+        width = text_width(line)
         if width > max_line_width:
             max_line_width = width
 
     # 动态宽度（考虑边距和行号区域）
-    width = min(
-        max(max_line_width + left_margin + right_margin + line_number_width, min_width),
-        max_width,
+    width = int(
+        min(
+            max(
+                max_line_width + left_margin + right_margin + line_number_width,
+                min_width,
+            ),
+            max_width,
+        )
     )
 
     # 创建图片
     img = Image.new("RGB", (width, height), color="#1E1E1E")  # VSCode风格的深色背景
     draw = ImageDraw.Draw(img)
 
+    # 逐字符粘贴缓存的字形蒙版，代替每行调用draw.text重新渲染
+    get_glyph = make_glyph_atlas(font) if hasattr(font, "getbbox") else None
+
+    def draw_line(x, y, text, fill):
+        if get_glyph is None:
+            draw.text((x, y), text, font=font, fill=fill)
+            return
+        for ch in text:
+            mask, left, top = get_glyph(ch)
+            if mask is not None:
+                gx, gy = round(x) + left, y + top
+                img.paste(fill, (gx, gy, gx + mask.width, gy + mask.height), mask)
+            x += text_width(ch)
+
+    # 超出图片高度的行不再绘制
+    visible_rows = max((height - 10) // line_height + 1, 0)
+
     # 绘制行号背景
     draw.rectangle([(0, 0), (left_margin, height)], fill="#2B2B2B")
 
     # 绘制行号
-    for i, line_num in enumerate(line_numbers):
+    for i, line_num in enumerate(line_numbers[:visible_rows]):
         if line_num != "":
             y_pos = 10 + i * line_height
             # 行号右对齐
             num_str = str(line_num)
-            bbox = (
-                font.getbbox(num_str)
-                if hasattr(font, "getbbox")
-                else font.getsize(num_str)
-            )
-            num_width = bbox[2] - bbox[0] if hasattr(font, "getbbox") else bbox[0]
+            num_width = text_width(num_str)
             x_pos = left_margin - num_width - 10
-            draw.text((x_pos, y_pos), num_str, font=font, fill="#6E7681")  # 行号颜色
+            draw_line(x_pos, y_pos, num_str, (110, 118, 129))  # 行号颜色 #6E7681
 
     # 绘制文本
     y = 10
-    for i, line in enumerate(processed_lines):
-        # 确定行颜色
-        if line.startswith("+"):
-            fill = (155, 185, 85)  # 柔和的绿色
-        elif line.startswith("-"):
-            fill = (224, 108, 117)  # 柔和的红色
-        elif line.startswith("@"):
-            fill = (86, 156, 214)  # 蓝色
-        else:
-            fill = (212, 212, 212)  # 浅灰色
+    for line in processed_lines[:visible_rows]:
+        # 根据首字符确定行颜色
+        marker = line[:1]
+        fill = DIFF_LINE_COLORS.get(marker, DIFF_DEFAULT_COLOR)
 
         # 移除diff标记以获取纯净的代码
         clean_line = line
-        if line.startswith(("+", "-", "@", " ")):
-            clean_line = line[1:] if len(line) > 1 else line
+        if marker in DIFF_MARKERS and len(line) > 1:
+            clean_line = line[1:]
 
-        draw.text((left_margin, y), clean_line, font=font, fill=fill)
+        draw_line(left_margin, y, clean_line, fill)
         y += line_height
 
     img.save(output_file)
 
 
+def render_diff(old_lines, new_lines, caption, output_file):
+    """
+    生成新旧内容的diff（在进程池中执行）：变更较小时返回文本消息，
+    否则把diff渲染为图片保存到output_file并返回None
+    """
+    diff_lines = build_diff(old_lines, new_lines)
+    text_message = build_text_diff_message(caption, diff_lines)
+    if not text_message:
+        diff_to_image("\n".join(diff_lines), output_file)
+    return text_message
+
+
 # === 异步消息发送管理器 ===
 class TelegramMessageManager:
-    def __init__(self, bot):
+    """
+    基于队列的消息发送器：调用方只负责入队，由多个消费者任务并发发送，
+    每个会话单独限制并发数，遇到Telegram限流(RetryAfter)时等待后重新入队
+    """
+
+    def __init__(self, bot, concurrency=None, workers=10, max_retries=3):
         self.bot = bot
-        self.semaphore = asyncio.Semaphore(5)  # 限制并发数为5
+        self.queue = asyncio.Queue()
+        self.concurrency = concurrency or {}  # 每个会话的并发上限，默认5
+        self.semaphores = {}
+        self.workers = workers
+        self.max_retries = max_retries
+        self.tasks = []
+
+    def start(self):
+        """启动消费者任务"""
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self.run_worker()) for _ in range(self.workers)
+            ]
+
+    async def close(self):
+        """等待队列中的消息全部发送完毕后停止消费者任务"""
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.queue.put(("message", chat_id, text, kwargs, 0))
+
+    async def send_photo(self, chat_id, photo, caption):
+        await self.queue.put(("photo", chat_id, photo, {"caption": caption}, 0))
+
+    def get_semaphore(self, chat_id):
+        if chat_id not in self.semaphores:
+            self.semaphores[chat_id] = asyncio.Semaphore(
+                self.concurrency.get(chat_id, 5)
+            )
+        return self.semaphores[chat_id]
 
-    async def send_message(self, chat_id, text):
-        async with self.semaphore:
+    async def run_worker(self):
+        while True:
+            item = await self.queue.get()
             try:
-                await self.bot.send_message(chat_id=chat_id, text=text)
-                await asyncio.sleep(0.5)  # 添加短暂延迟
+                await self.deliver(*item)
             except Exception as e:
-                logging.error(f"发送消息失败: {e}")
-                raise
+                logging.error(f"发送队列处理失败: {e}")
+            finally:
+                self.queue.task_done()
 
-    async def send_photo(self, chat_id, photo_path, caption):
-        async with self.semaphore:
+    async def deliver(self, kind, chat_id, payload, kwargs, attempt):
+        async with self.get_semaphore(chat_id):
             try:
-                with open(photo_path, "rb") as photo:
-                    await self.bot.send_photo(
-                        chat_id=chat_id, photo=photo, caption=caption
-                    )
-                await asyncio.sleep(1)  # 图片发送后添加稍长的延迟
+                if kind == "photo":
+                    with open(payload, "rb") as photo:
+                        await self.bot.send_photo(
+                            chat_id=chat_id, photo=photo, **kwargs
+                        )
+                    await asyncio.sleep(1)  # 图片发送后添加稍长的延迟
+                else:
+                    await self.bot.send_message(chat_id=chat_id, text=payload, **kwargs)
+                    await asyncio.sleep(0.5)  # 添加短暂延迟
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
             except Exception as e:
-                logging.error(f"发送图片失败: {e}")
-                raise
-
-
-# 创建消息管理器实例
-message_manager = TelegramMessageManager(bot)
+                logging.error(f"发送{'图片' if kind == 'photo' else '消息'}失败: {e}")
+                return
+
+        # 被限流：在信号量之外等待，然后重新入队
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        if attempt >= self.max_retries:
+            logging.error(f"发送失败，已重试 {attempt} 次: {chat_id}")
+            return
+        logging.warning(f"触发Telegram限流，{retry_after} 秒后重试")
+        await asyncio.sleep(retry_after)
+        await self.queue.put((kind, chat_id, payload, kwargs, attempt + 1))
+
+
+# 创建消息管理器实例（管理员5个并发，频道10个并发）
+message_manager = TelegramMessageManager(
+    bot, concurrency={ADMIN_USER_ID: 5, CHANNEL_ID: 10}
+)
 
 
 # === 核心逻辑 ===
-async def compare_and_notify_async(url, dynamic=False, is_text=False):
-    content = await get_page_content(url, dynamic)  # 使用await调用异步函数
+@dataclass(frozen=True)
+class Site:
+    """监测站点，相关文件路径在读取站点列表时一次性算好"""
+
+    type: str
+    url: str
+    snapshot_file: Path
+    diff_image_file: Path
+
+    @classmethod
+    def from_entry(cls, type_, url):
+        name = safe_filename(url)
+        snapshot_file = DATA_DIR / f"{name}.txt"
+        if SNAPSHOT_COMPRESSION == "zstd":
+            snapshot_file = snapshot_file.with_suffix(".txt.zst")
+        return cls(
+            type=type_,
+            url=url,
+            snapshot_file=snapshot_file,
+            diff_image_file=DATA_DIR / f"{name}_diff.png",
+        )
+
+    @property
+    def dynamic(self):
+        return self.type == "dynamic"
+
+    @property
+    def is_text(self):
+        return self.type == "txt"
+
+
+async def compare_and_notify_async(client, browser, executor, site, index):
+    url = site.url
+    dynamic = site.dynamic
+    is_text = site.is_text
+    snapshot_file = site.snapshot_file
+    diff_image_file = site.diff_image_file
+    # 快照格式版本和站点类型，格式化规则变化后哈希和缓存校验信息都会失效
+    kind = f"{SNAPSHOT_VERSION}|{'txt' if is_text else 'html'}"
+    entry = index.get(url)
+    if not isinstance(entry, dict) or entry.get("kind") != kind:
+        entry = {}
+
+    # 已有快照和哈希时才发起条件请求，确保304时本地快照是最新的
+    validators = None
+    if not dynamic and snapshot_file.exists() and entry.get("hash"):
+        validators = entry
+
+    content, new_validators = await get_page_content(
+        url, dynamic, client, browser, validators
+    )
     timestamp = get_cst_time()
-    snapshot_file = DATA_DIR / f"{safe_filename(url)}.txt"
-    diff_image_file = DATA_DIR / f"{safe_filename(url)}_diff.png"
+
+    # 服务器返回304 → 内容未变化，无需读取快照
+    if content is None:
+        logging.info(f"内容未变化（304）: {url}")
+        log_change(timestamp, url, "已抓取/更新")
+        return
 
     # 网站访问失败 → 发送给管理员
     if content.startswith("ERROR:"):
         message = f"⚠️ 无法访问: {url}\n时间: {timestamp}\n错误信息: {content}"
         await message_manager.send_message(ADMIN_USER_ID, message)
-        with LOG_FILE.open("a", encoding="utf-8") as log:
-            log.write(f"[{timestamp}] {url} 访问失败: {content}\n")
+        log_change(timestamp, url, f"访问失败: {content}")
         return
 
-    # 格式化HTML内容（非纯文本时）
-    if not is_text:
-        content = format_html_content(content)
-
     first_run = not snapshot_file.exists()
+
+    # 与上次抓取内容的哈希一致时，跳过格式化以及旧快照的读取和比较
+    hasher = hashlib.blake2b(f"{kind}\n".encode("utf-8"), digest_size=16)
+    hasher.update(content.encode("utf-8"))
+    content_hash = hasher.hexdigest()
+    unchanged = not first_run and entry.get("hash") == content_hash
+
+    # 格式化HTML内容（非纯文本时），在线程中执行，不阻塞其他站点的抓取
+    if not is_text and not unchanged:
+        content = await asyncio.to_thread(format_html_content, content)
+
+    # 只有首次抓取、内容变化或快照需要重建时才重写快照
+    snapshot_dirty = first_run
+
     if first_run:
-        snapshot_file.write_text(content, encoding="utf-8")
         message = f"📥📥 首次抓取内容: {url}\n时间: {timestamp}"
         await message_manager.send_message(CHANNEL_ID, message)
         logging.info(f"首次抓取: {url}")
+    elif unchanged:
+        logging.info(f"内容未变化: {url}")
     else:
         try:
-            old_content = snapshot_file.read_text(encoding="utf-8", errors="ignore")
-            # 格式化旧内容以保持一致性
-            if not is_text:
-                old_content = format_html_content(old_content)
-
-            old_content = normalize_text(old_content)
-
-            if old_content != content:
-                # 尝试使用Pygments生成带语法高亮的差异图片
-                try:
-                    # 根据URL猜测文件类型
-                    if "." in url:
-                        file_ext = url.split(".")[-1]
-                        if len(file_ext) > 5:  # 避免过长的扩展名
-                            file_ext = "txt"
-                    else:
-                        file_ext = "txt"
-
-                    # 生成高亮图片
-                    highlighted_old = highlight_code(old_content, f"old.{file_ext}")
-                    highlighted_new = highlight_code(content, f"new.{file_ext}")
-
-                    if highlighted_old and highlighted_new:
-                        # 如果高亮成功，使用高亮后的图片
-                        # 这里可以添加代码将两个图片合并为对比图片
-                        # 暂时使用原有的diff文本作为备选
-                        pass
-                except Exception as e:
-                    logging.warning(f"代码高亮失败，使用文本diff: {e}")
-
-                # 生成更精确的diff
-                diff_lines = list(
-                    difflib.unified_diff(
-                        old_content.splitlines(keepends=False),
-                        content.splitlines(keepends=False),
-                        n=3,  # 增加上下文行数
-                    )
+            # 快照保存的已是格式化后的内容，无需再次格式化
+            old_lines = await asyncio.to_thread(read_snapshot, snapshot_file, is_text)
+            new_lines = split_lines(content)
+
+            if old_lines is None:
+                # 旧快照的格式版本已过期，直接用新格式重建
+                logging.info(f"快照格式已更新，重建快照: {url}")
+                snapshot_dirty = True
+            elif old_lines != new_lines:
+                # 在进程池中生成diff和diff图片（纯CPU计算，不阻塞事件循环，
+                # 多个站点可在多核上并行）
+                caption = f"🔍🔍 内容更新: {url}\n时间: {timestamp}"
+                text_message = await asyncio.get_running_loop().run_in_executor(
+                    executor,
+                    render_diff,
+                    old_lines,
+                    new_lines,
+                    caption,
+                    str(diff_image_file),
                 )
-                diff_text = "\n".join(diff_lines)
 
-                # 生成diff图片
-                diff_to_image(diff_text, diff_image_file)
-
-                # 发送更新通知
-                caption = f"🔍🔍 内容更新: {url}\n时间: {timestamp}"
-                await message_manager.send_photo(CHANNEL_ID, diff_image_file, caption)
+                # 小的变更直接以文本发送，省去生成和上传图片
+                if text_message:
+                    await message_manager.send_message(
+                        CHANNEL_ID, text_message, parse_mode="MarkdownV2"
+                    )
+                else:
+                    await message_manager.send_photo(
+                        CHANNEL_ID, diff_image_file, caption
+                    )
                 logging.info(f"检测到更新: {url}")
+                snapshot_dirty = True
             else:
                 logging.info(f"内容未变化: {url}")
         except Exception as e:
             logging.error(f"比较内容时出错: {e}")
             message = f"⚠️ 内容比较失败: {url}\n错误信息: {e}"
             await message_manager.send_message(ADMIN_USER_ID, message)
+            snapshot_dirty = True
 
     # 写日志
-    with LOG_FILE.open("a", encoding="utf-8") as log:
-        log.write(f"[{timestamp}] {url} 已抓取/更新\n")
+    log_change(timestamp, url, "已抓取/更新")
 
     # 更新快照
-    snapshot_file.write_text(content, encoding="utf-8")
-
-
-async def main_async():
-    if not BOT_TOKEN or not CHANNEL_ID or not ADMIN_USER_ID:
-        raise ValueError(
-            "请设置 TELEGRAM_BOT_TOKEN, TELEGRAM_CHANNEL_ID 和 TELEGRAM_ADMIN_ID 环境变量"
-        )
+    if snapshot_dirty:
+        await asyncio.to_thread(write_snapshot, snapshot_file, content)
+
+    # 快照写好之后再更新索引中的哈希和ETag/Last-Modified（运行结束时统一保存）
+    index[url] = {
+        "kind": kind,
+        "hash": content_hash,
+        **{key: value for key, value in new_validators.items() if value},
+    }
 
-    # 配置日志
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[logging.FileHandler("monitor.log"), logging.StreamHandler()],
-    )
 
+async def check_all_sites():
     # 字体检测
     font_path = Path(FONT_FILE)
     if font_path.exists():
@@ -556,16 +907,18 @@ async def main_async():
         )
 
     # 读取监测站点列表
-    urls = []
     try:
-        with open("sites.txt", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                type_, url = line.split("|", 1)
-                urls.append((type_.strip(), url.strip()))
-        logging.info(f"成功读取 {len(urls)} 个监测站点")
+        # 每行格式为 "类型|URL"，忽略空行和#开头的注释
+        lines = [
+            line.strip()
+            for line in Path("sites.txt").read_text(encoding="utf-8").splitlines()
+        ]
+        sites = [
+            Site.from_entry(*(part.strip() for part in line.split("|", 1)))
+            for line in lines
+            if line and not line.startswith("#")
+        ]
+        logging.info(f"成功读取 {len(sites)} 个监测站点")
     except Exception as e:
         logging.error(f"读取sites.txt失败: {e}")
         await message_manager.send_message(
@@ -573,17 +926,84 @@ async def main_async():
         )
         return
 
-    # 处理每个站点
-    for type_, url in urls:
-        dynamic = type_ == "dynamic"
-        is_text = type_ == "txt"
-        try:
-            logging.info(f"开始处理: {url} (类型: {type_})")
-            await compare_and_notify_async(url, dynamic=dynamic, is_text=is_text)
-        except Exception as e:
-            logging.error(f"处理站点 {url} 时出错: {e}")
-            message = f"⚠️ 处理站点失败: {url}\n错误信息: {e}"
-            await message_manager.send_message(ADMIN_USER_ID, message)
+    # 读取站点索引，所有站点处理完后一次写回
+    index = load_index()
+
+    # 并发处理所有站点
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SITES)
+
+    async def process_site(client, browser, executor, site):
+        async with sem:
+            try:
+                logging.info(f"开始处理: {site.url} (类型: {site.type})")
+                await compare_and_notify_async(client, browser, executor, site, index)
+            except Exception as e:
+                logging.error(f"处理站点 {site.url} 时出错: {e}")
+                message = f"⚠️ 处理站点失败: {site.url}\n错误信息: {e}"
+                await message_manager.send_message(ADMIN_USER_ID, message)
+
+    async with AsyncExitStack() as stack:
+        # 所有静态请求共享一个HTTP/2客户端，复用连接并省去重复的TCP/TLS握手
+        # （安装了brotli时httpx会自动声明并解压br编码的响应）
+        client = await stack.enter_async_context(
+            httpx.AsyncClient(
+                http2=True,
+                follow_redirects=True,
+                timeout=15,
+                limits=httpx.Limits(max_connections=64),
+            )
+        )
+
+        # 所有动态页面共享一个浏览器实例，避免每个URL都启动Chromium
+        browser = None
+        if any(site.dynamic for site in sites):
+            try:
+                # 只有存在动态页面时才导入Playwright
+                from playwright.async_api import async_playwright
+
+                p = await stack.enter_async_context(async_playwright())
+                browser = await p.chromium.launch(headless=True)
+                stack.push_async_callback(browser.close)
+            except Exception as e:
+                # 启动失败只通知一次，静态站点照常检查
+                logging.error(f"启动浏览器失败: {e}")
+                await message_manager.send_message(
+                    ADMIN_USER_ID,
+                    f"⚠️ 启动浏览器失败，动态页面将无法抓取\n错误信息: {e}",
+                )
+
+        # diff计算和图片渲染放到进程池，多个站点的渲染可在多核上并行
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=os.cpu_count()))
+
+        await asyncio.gather(
+            *(process_site(client, browser, executor, site) for site in sites),
+            return_exceptions=True,
+        )
+
+    # 只保留sites.txt中仍在监测的站点
+    save_index({site.url: index[site.url] for site in sites if site.url in index})
+
+
+async def main_async():
+    if not BOT_TOKEN or not CHANNEL_ID or not ADMIN_USER_ID:
+        raise ValueError(
+            "请设置 TELEGRAM_BOT_TOKEN, TELEGRAM_CHANNEL_ID 和 TELEGRAM_ADMIN_ID 环境变量"
+        )
+
+    # 配置日志
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler("monitor.log"), logging.StreamHandler()],
+    )
+
+    # 启动消息发送队列，退出前等待队列中的消息全部发送
+    message_manager.start()
+    try:
+        await check_all_sites()
+    finally:
+        await message_manager.close()
+        flush_change_log()
 
 
 def main():